@@ -0,0 +1,137 @@
+#! /usr/bin/python3
+
+# Measures keystroke latency in ScriptEdit on synthetic scripts of
+# increasing length, with syntax highlighting off and on.  Runs without
+# a display:
+#
+#     python bench_keystroke_latency.py [--pages 10 50 100 200]
+#
+# For each size it prints the median and 95th percentile time to handle
+# one keystroke, and separately the time spent inside the highlighter.
+# The highlighter column should stay flat as the script grows; whatever
+# growth there is in the totals shows up with highlighting off as well,
+# and comes from QTextEdit relaying out the document, not from
+# highlighting.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+os.environ.setdefault("QT_QPA_PLATFORM","offscreen")
+
+from PySide2 import QtCore, QtGui, QtWidgets
+from PySide2.QtCore import Qt
+
+import downplay
+
+
+WORDS = ( "the a man woman runs walks door opens slowly quickly table gun "
+          "letter window rain night" ).split()
+
+def sentence(rng,n_words):
+    return " ".join(rng.choice(WORDS) for i in range(n_words)).capitalize() + "."
+
+def make_script(n_pages,seed=1):
+    # Adds scenes until the paginated script is n_pages long
+    rng = random.Random(seed)
+    paragraphs = []
+    n_scenes = 0
+    while True:
+        scene = [ ("ACTION","%s. PLACE %d - NIGHT"
+                   % (rng.choice(["INT","EXT"]),n_scenes)),
+                  ("ACTION",""),
+                  ("ACTION",sentence(rng,rng.randint(5,40))),
+                  ("ACTION","") ]
+        for i in range(rng.randint(1,4)):
+            scene.append(("NAME",rng.choice(["BOB","ALICE","CAROL (V.O.)"])))
+            if rng.random() < 0.3:
+                scene.append(("PARENTHETICAL","(beat)"))
+            scene.append(("DIALOGUE",sentence(rng,rng.randint(3,60))))
+            scene.append(("ACTION",""))
+        paragraphs.extend(scene)
+        n_scenes += 1
+        if n_scenes % 10 == 0:
+            text = downplay.paginate_screenplay_lines(paragraphs)
+            if len(text) // 60 >= n_pages:
+                return paragraphs, len(text) // 60
+
+
+class TimedHighlighter(downplay.ScriptHighlighter):
+
+    def __init__(self,document=None):
+        super().__init__(document)
+        self.elapsed = 0.0
+
+    def highlightBlock(self,text):
+        start = time.perf_counter()
+        super().highlightBlock(text)
+        self.elapsed += time.perf_counter() - start
+
+
+def measure(app,paragraphs,highlighting,n_keystrokes):
+    script_edit = downplay.ScriptEdit()
+    script_edit.highlighter.setDocument(None)
+    script_edit.highlighter = TimedHighlighter()
+    script_edit.set_highlighting(highlighting)
+    script_edit.resize(620,700)
+    script_edit.show()
+    script_edit.load_paragraphs(paragraphs)
+    app.processEvents()
+
+    # Type at the end of an action paragraph in the middle of the script
+    document = script_edit.document()
+    block = document.findBlock(document.characterCount()//2)
+    while block.text() == "" \
+          or block.blockFormat().leftMargin() != 0:
+        block = block.next()
+    cursor = script_edit.textCursor()
+    cursor.setPosition(block.position()+block.length()-1)
+    script_edit.setTextCursor(cursor)
+    app.processEvents()
+
+    script_edit.highlighter.elapsed = 0.0
+    times = []
+    for i in range(n_keystrokes):
+        start = time.perf_counter()
+        event = QtGui.QKeyEvent(QtCore.QEvent.KeyPress,Qt.Key_A,
+                                Qt.NoModifier,"a")
+        QtWidgets.QApplication.sendEvent(script_edit,event)
+        app.processEvents()
+        times.append(time.perf_counter()-start)
+    times.sort()
+    result = ( document.blockCount(),
+               times[len(times)//2]*1000,
+               times[len(times)*95//100]*1000,
+               script_edit.highlighter.elapsed/n_keystrokes*1000 )
+    script_edit.document().setModified(False)
+    script_edit.close()
+    script_edit.deleteLater()
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark keystroke latency')
+    ap.add_argument("--pages",default=[10,50,100,200],type=int,nargs='+',
+                    help="Script lengths to measure, in pages")
+    ap.add_argument("--keystrokes",default=200,type=int,
+                    help="Keystrokes to time at each length")
+    args = ap.parse_args()
+
+    app = QtWidgets.QApplication([])
+    print("%6s %7s %12s %10s %10s %14s"
+          % ("pages","blocks","highlighting","median ms","p95 ms",
+             "highlighter ms"))
+    for n_pages in args.pages:
+        paragraphs,actual_pages = make_script(n_pages)
+        for highlighting in (False,True):
+            n_blocks,median,p95,highlighter = measure(
+                app,paragraphs,highlighting,args.keystrokes)
+            print("%6d %7d %12s %10.3f %10.3f %14.4f"
+                  % (actual_pages,n_blocks,"on" if highlighting else "off",
+                     median,p95,highlighter))
+
+
+if __name__ == '__main__':
+    main()
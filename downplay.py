@@ -8,7 +8,17 @@ import os
 import re
 import traceback
 import argparse
+import threading
+import time
+import logging
+import concurrent.futures
+import csv
+import json
+import io
+import hashlib
+import tempfile
 import xml.etree.ElementTree as ET
+import xml.parsers.expat
 
 from PySide2 import QtCore, QtGui, QtWidgets
 from PySide2.QtCore import Qt
@@ -16,10 +26,33 @@ from PySide2.QtCore import Qt
 try:
     from reportlab.pdfgen import canvas
     from reportlab.lib import pagesizes, units
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab import Version as reportlab_version
     HAS_REPORTLAB = True
 except ImportError:
     HAS_REPORTLAB = False
 
+logger = logging.getLogger("downplay")
+
+
+# Indent and width, in characters, of each style when formatted as text
+STYLE_FORMATS = {
+    'ACTION': (0,60),
+    'DIALOGUE': (10,36),
+    'NAME': (20,20),
+    'PARENTHETICAL': (15,25),
+    'TRANSITION': (45,15),
+    }
+
+SCENE_HEADING_RE = re.compile(r"\s*(INT\.?/EXT|INT|EXT|EST|I/E)[. ]",re.I)
+
+ACT_HEADING_RE = re.compile(r"\s*(ACT\s+\w+|TEASER|COLD OPEN|TAG)\s*$",re.I)
+
+def is_scene_heading(style,text):
+    return style == "ACTION" and SCENE_HEADING_RE.match(text) is not None
+
+def is_act_heading(style,text):
+    return style == "ACTION" and ACT_HEADING_RE.match(text) is not None
 
 
 def format_paragraph(text,indent,width):
@@ -56,130 +89,870 @@ def format_paragraph(text,indent,width):
     return lines
 
 def format_screenplay(xdownplay):
+    return "\n".join(format_screenplay_lines(iter_paragraphs(xdownplay)))
+
+def format_screenplay_lines(paragraphs):
     text = []
-    for xp in xdownplay.findall('p'):
-        if xp.text in (None,""):
+    for style,paragraph in paragraphs:
+        if paragraph in (None,""):
             text.append("")
             continue
-        style = xp.attrib["style"]
-        if style == "ACTION":
-            text.extend(format_paragraph(xp.text,0,60))
-        elif style == "DIALOGUE":
-            text.extend(format_paragraph(xp.text,10,36))
-        elif style == "NAME":
-            text.extend(format_paragraph(xp.text,20,20))
-        elif style == "PARENTHETICAL":
-            text.extend(format_paragraph(xp.text,15,25))
-        elif style == "TRANSITION":
-            text.extend(format_paragraph(xp.text,45,15))
-        else:
-            assert False
+        indent,width = STYLE_FORMATS[style]
+        text.extend(format_paragraph(paragraph,indent,width))
     text.append("")
-    return "\n".join(text)
+    return text
 
 def paginate_screenplay(xdownplay):
+    return "\n".join(paginate_screenplay_lines(iter_paragraphs(xdownplay)))
+
+def paginate_screenplay_lines(paragraphs,sources=None,*,first_page=1,
+                              last=True):
+    # If sources is a list, it is filled in parallel with the returned
+    # lines: the index of the paragraph each line came from, or None for
+    # padding, page numbers and (MORE).  A script can be paginated in
+    # pieces that each start on a new page by passing the page each
+    # piece starts on, and last=False for all but the final piece.
+    def emit(line,source=None):
+        text.append(line)
+        if sources is not None:
+            sources.append(source)
     def page_break():
         nonlocal line_number, page_number, eat_space
         while line_number < 60:
-            text.append("")
+            emit("")
             line_number += 1
         line_number = 0
         page_number += 1
         eat_space = True
-    def add_line(line):
+    def add_line(line,source=None):
         nonlocal line_number, page_number, eat_space
         if eat_space and line in (None,""):
             eat_space = False
             return
         while line_number < 4:
             if line_number == 2 and page_number > 1:
-                text.append("%*s%d." % (55,"",page_number))
+                emit("%*s%d." % (55,"",page_number))
             else:
-                text.append("")
+                emit("")
             line_number += 1
-        text.append(line)
+        emit(line,source)
         line_number += 1
         if line_number >= 56:
             page_break()
         else:
             eat_space = False
-    def add_lines(lines):
+    def add_lines(lines,source=None):
         for line in lines:
-            add_line(line)
+            add_line(line,source)
     def add_clump(reserve=0):
         if len(clump) == 0:
             return
-        if len(clump) > 10:  # don't even try
-            add_lines(clump)
-            clump.clear()
-            return
-        if line_number + len(clump) + reserve > 56:
+        if len(clump) <= 10 \
+           and line_number + len(clump) + reserve > 56:  # else don't even try
             page_break()
-        add_lines(clump)
+        for line,source in clump:
+            add_line(line,source)
         clump.clear()
     text = []
     line_number = 0
-    page_number = 1
-    eat_space = False
+    page_number = first_page
+    eat_space = first_page > 1
     clump = []
-    for xp in xdownplay.findall('p'):
-        if xp.text in (None,""):
+    for index,(style,paragraph) in enumerate(paragraphs):
+        if paragraph in (None,""):
             add_clump()
-            add_line("")
+            add_line("",index)
             continue
-        style = xp.attrib["style"]
+        lines = format_paragraph(paragraph,*STYLE_FORMATS[style])
         if style == "ACTION":
             add_clump()
-            add_lines(format_paragraph(xp.text,0,60))
+            add_lines(lines,index)
         elif style == "DIALOGUE":
-            paragraph = format_paragraph(xp.text,10,36)
-            add_clump(max(2,len(paragraph)))
-            while line_number + len(paragraph) > 56:
+            add_clump(max(2,len(lines)))
+            while line_number + len(lines) > 56:
                 n_balance = 55-line_number
-                balance,paragraph = paragraph[:n_balance],paragraph[n_balance:]
-                add_lines(balance)
+                balance,lines = lines[:n_balance],lines[n_balance:]
+                add_lines(balance,index)
                 add_lines(("%*s(MORE)" % (20,""),))
-            add_lines(paragraph)
-        elif style == "NAME":
-            clump.extend(format_paragraph(xp.text,20,20))
-        elif style == "PARENTHETICAL":
-            clump.extend(format_paragraph(xp.text,15,25))
+            add_lines(lines,index)
+        elif style in ("NAME","PARENTHETICAL"):
+            clump.extend((line,index) for line in lines)
         elif style == "TRANSITION":
             add_clump()
-            add_lines(format_paragraph(xp.text,45,15))
+            add_lines(lines,index)
         else:
             assert False
     add_clump()
-    page_break()
-    return "\n".join(text)
-
-def save_screenplay_as_text(xdownplay,txt_filename,*,paginated=True):
-    if paginated:
-        text = paginate_screenplay(xdownplay)
-    else:
-        text = format_screenplay(xdownplay)
-    with open(txt_filename,"w",encoding='utf-8') as flo:
-        flo.write(text)
+    if last or line_number != 0:
+        page_break()
+    return text
+
+def report_screenplay(paragraphs,text,sources):
+    # Production breakdown from a single pass over the paginator's
+    # output.  Scene lengths are in eighths of the 52 line page body,
+    # counted to the start of the next scene, with a minimum of 1/8.
+    def body_line(n):
+        page,line_number = divmod(n,60)
+        return page*52 + min(max(line_number-4,0),52)
+    def end_scene(n):
+        if scenes:
+            scene = scenes[-1]
+            n_lines = body_line(n) - scene.pop("start")
+            scene["eighths"] = max(1,round(n_lines*8/52))
+    scenes = []
+    characters = {}
+    speaker = None
+    previous = None
+    last = 0
+    for n,source in enumerate(sources):
+        if source is None:
+            continue
+        last = n
+        first = source != previous
+        previous = source
+        style,paragraph = paragraphs[source]
+        if paragraph in (None,""):
+            # Blank blocks often keep the style of the block before them;
+            # they count as nothing, and end any speech in progress
+            speaker = None
+            continue
+        if first and is_scene_heading(style,paragraph):
+            end_scene(n)
+            page,line_number = divmod(n,60)
+            scenes.append({
+                "scene": len(scenes)+1,
+                "heading": " ".join(paragraph.split()),
+                "page": page+1,
+                "line": line_number+1,
+                "start": body_line(n),
+                "characters": [],
+                })
+        elif style == "NAME":
+            if first:
+                speaker = " ".join(paragraph.split("(",1)[0].split())
+                counts = characters.setdefault(
+                    speaker,{"cues": 0, "dialogue_lines": 0})
+                counts["cues"] += 1
+                if scenes and speaker not in scenes[-1]["characters"]:
+                    scenes[-1]["characters"].append(speaker)
+        elif style == "DIALOGUE":
+            if speaker is not None:
+                characters[speaker]["dialogue_lines"] += 1
+        elif style != "PARENTHETICAL":
+            speaker = None
+    end_scene(last+1)
+    return {
+        "pages": len(text)//60,
+        "scenes": scenes,
+        "characters": [ dict(character=name,**counts)
+                        for name,counts in sorted(characters.items()) ],
+        }
 
-def save_screenplay_as_pdf(xdownplay,pdf_filename):
-    text = paginate_screenplay(xdownplay)
-    pdf = canvas.Canvas(pdf_filename,pagesize=pagesizes.letter)
-    font_set = False
-    line_number = 0
-    for line in text.split("\n"):
+def format_eighths(eighths):
+    pages,eighths = divmod(eighths,8)
+    if pages == 0:
+        return "%d/8" % eighths
+    elif eighths == 0:
+        return "%d" % pages
+    return "%d %d/8" % (pages,eighths)
+
+# The renderers keep all their state in locals and write only to the
+# sink they are given, so any number of them can run at once in
+# different threads.  Text formats write str to a text sink, PDF writes
+# bytes to a binary sink.
+
+def render(paragraphs,fmt,sink,**options):
+    try:
+        renderer = RENDERERS[fmt]
+    except KeyError:
+        raise ValueError("unknown output format %r" % (fmt,))
+    renderer(paragraphs,sink,**options)
+
+def write_text(paragraphs,sink):
+    sink.write("\n".join(format_screenplay_lines(paragraphs)))
+
+def write_pages(paragraphs,sink):
+    sink.write("\n".join(paginate_screenplay_lines(paragraphs)))
+
+_reportlab_lock = threading.Lock()
+_reportlab_ready = False
+
+def prepare_reportlab():
+    # reportlab loads font metrics into module-level registries the
+    # first time a font is used.  Do that once, under a lock, so that
+    # concurrent renders only ever read them.
+    global _reportlab_ready
+    with _reportlab_lock:
+        if not _reportlab_ready:
+            pdfmetrics.getFont("Courier")
+            _reportlab_ready = True
+
+def pdf_render_settings():
+    # Everything besides a page's lines that affects how it is drawn,
+    # and how page content is stored
+    return ("Courier",12,1.7*units.inch,10.5*units.inch,12,
+            pagesizes.letter,reportlab_version,"font names")
+
+# A string or a font selection in a page's content stream.  reportlab
+# escapes every parenthesis inside strings, so the strings can be
+# skipped over without counting nesting.
+PDF_FONT_RE = re.compile(r"\((?:\\.|[^\\()])*\)|(/[^\s/()]+)(?= [\d.]+ Tf)")
+
+def rename_pdf_fonts(content,rename):
+    def replace(m):
+        if m.group(1) is None:
+            return m.group(0)
+        return rename(m.group(1)[1:])
+    return PDF_FONT_RE.sub(replace,content)
+
+def draw_pdf_page(pdf,lines):
+    # Draws one page and returns the content stream operators it added,
+    # not counting the font selection, which replay_pdf_page redoes.
+    # The canvas refers to fonts by names it assigns in the order they
+    # are first used, such as /F3 for the Symbol font that stands in for
+    # characters Courier lacks, so the content returned names fonts by
+    # their PostScript names instead, to be usable in another canvas.
+    if all(line == "" for line in lines):
+        return ""
+    pdf.setFont("Courier",12)
+    start = len(pdf._code)
+    for line_number,line in enumerate(lines):
         if line != "":
-            if not font_set:
-                pdf.setFont("Courier",12)
-                font_set = True
             pdf.drawString(1.7*units.inch,10.5*units.inch-line_number*12,line)
-        line_number += 1
-        if line_number >= 60:
-            line_number = 0
-            pdf.showPage()
-            font_set = False
+    font_names = { internal_name[1:]: "/" + font_name for font_name,internal_name
+                   in pdf._doc.fontMapping.items() }
+    return rename_pdf_fonts("\n".join(pdf._code[start:]),font_names.get)
+
+def replay_pdf_page(pdf,content):
+    if content != "":
+        pdf.setFont("Courier",12)
+        pdf.addLiteral(rename_pdf_fonts(content,pdf._doc.getInternalFontName))
+
+def write_pdf(paragraphs,sink,*,invariant=None,cache=None):
+    # Pass invariant=True for byte-for-byte reproducible output; otherwise
+    # reportlab stamps each file with the current time.  With a PageCache,
+    # pages already rendered with the same lines are copied from the
+    # cache rather than drawn.
+    prepare_reportlab()
+    text = paginate_screenplay_lines(paragraphs)
+    pdf = canvas.Canvas(sink,pagesize=pagesizes.letter,invariant=invariant)
+    if cache is not None:
+        settings = pdf_render_settings()
+    for start in range(0,len(text),60):
+        lines = text[start:start+60]
+        if cache is None:
+            draw_pdf_page(pdf,lines)
+        else:
+            key = cache.key(settings,lines)
+            content = cache.get(key)
+            if content is None:
+                content = draw_pdf_page(pdf,lines)
+                cache.put(key,content)
+            else:
+                replay_pdf_page(pdf,content)
+        pdf.showPage()
     pdf.save()
 
 
+# Sharded export.  The script is split before each scene or act heading
+# and every shard starts on a new page, so the shards can be paginated
+# and drawn independently in worker processes.  A first round paginates
+# each shard; the parent renumbers the page headers to run continuously
+# across shards, and for PDF a second round draws the pages, which the
+# parent joins.  When every split already falls at the top of a page the
+# output is identical to render().
+
+SHARD_BOUNDARIES = {
+    'scene': is_scene_heading,
+    'act': is_act_heading,
+    }
+
+def split_shards(paragraphs,split_at):
+    is_boundary = SHARD_BOUNDARIES[split_at]
+    shards = [[]]
+    for style,text in paragraphs:
+        if shards[-1] and is_boundary(style,text):
+            shards.append([])
+        shards[-1].append((style,text))
+    return shards
+
+def paginate_shard(shard,first_page,last):
+    return paginate_screenplay_lines(shard,first_page=first_page,last=last)
+
+def renumber_pages(text,first_page):
+    # Rewrites the page number headers of text paginated from page 2 on.
+    # A blank page left after content that ends exactly at the bottom of
+    # a page has no header, and keeps none.
+    for page,start in enumerate(range(0,len(text),60),first_page):
+        if text[start+2]:
+            text[start+2] = "%*s%d." % (55,"",page)
+
+def draw_shard(text):
+    prepare_reportlab()
+    pdf = canvas.Canvas(io.BytesIO(),pagesize=pagesizes.letter)
+    pages = []
+    for start in range(0,len(text),60):
+        pages.append(draw_pdf_page(pdf,text[start:start+60]))
+        pdf.showPage()
+    return pages
+
+def render_sharded(paragraphs,fmt,sink,*,split_at="scene",max_workers=None,
+                   invariant=None):
+    if fmt not in ("pages","pdf"):
+        raise ValueError("sharded output must be paginated text or PDF")
+    shards = split_shards(paragraphs,split_at)
+    lasts = [False]*(len(shards)-1) + [True]
+    chunksize = max(1,len(shards)//32)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        # Page numbers only change the page headers, not the layout, so
+        # every shard after the first is paginated as if from page 2,
+        # and given its real numbers afterwards
+        guesses = [1] + [2]*(len(shards)-1)
+        texts = list(executor.map(paginate_shard,shards,guesses,lasts,
+                                  chunksize=chunksize))
+        page_number = len(texts[0]) // 60 + 1
+        for text in texts[1:]:
+            renumber_pages(text,page_number)
+            page_number += len(text) // 60
+        if fmt == "pages":
+            sink.write("\n".join(line for text in texts for line in text))
+            return
+        results = executor.map(draw_shard,texts,chunksize=chunksize)
+        pdf = canvas.Canvas(sink,pagesize=pagesizes.letter,
+                            invariant=invariant)
+        for pages in results:
+            for content in pages:
+                replay_pdf_page(pdf,content)
+                pdf.showPage()
+        pdf.save()
+
+
+class PageCache:
+
+    # Rendered page content on disk, one file per page, named by a hash
+    # of the page's lines and the render settings, so identical pages
+    # are shared between exports and between scripts.  Reading a page
+    # touches its file; once the cache grows past max_size the least
+    # recently used pages are deleted.  An instance can be shared
+    # between threads.
+
+    def __init__(self,dirname,max_size=64*1024*1024):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(dirname,exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self):
+        return [ entry for entry in os.scandir(self.dirname)
+                 if entry.is_file() and not entry.name.endswith(".tmp") ]
+
+    @staticmethod
+    def key(settings,lines):
+        digest = hashlib.sha256(repr(settings).encode('utf-8'))
+        for line in lines:
+            digest.update(b"\n")
+            digest.update(line.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self,key):
+        filename = os.path.join(self.dirname,key)
+        try:
+            with open(filename,"rb") as flo:
+                data = flo.read()
+            os.utime(filename)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data.decode('utf-8')
+
+    def put(self,key,content):
+        data = content.encode('utf-8')
+        filename = os.path.join(self.dirname,key)
+        fd,tmp_filename = tempfile.mkstemp(suffix=".tmp",dir=self.dirname)
+        with os.fdopen(fd,"wb") as flo:
+            flo.write(data)
+        os.replace(tmp_filename,filename)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Other processes may share the directory, so go by what is
+        # actually there
+        entries = []
+        for entry in self.entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime,stat.st_size,entry.path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime,entry_size,path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.size = size
+
+    def statistics(self):
+        with self.lock:
+            return self.hits, self.misses
+
+    def hit_rate(self):
+        hits,misses = self.statistics()
+        total = hits + misses
+        return hits / total if total else 0.0
+
+    def log_statistics(self,since=(0,0)):
+        # Logs the hits and misses since an earlier snapshot from
+        # statistics(), or since the cache was opened
+        hits,misses = self.statistics()
+        hits -= since[0]
+        misses -= since[1]
+        total = hits + misses
+        logger.info("page cache %s: %d hits, %d misses, %.0f%% hit rate",
+                    self.dirname,hits,misses,
+                    hits / total * 100 if total else 0.0)
+
+
+def save_screenplay_as_text(xdownplay,txt_filename,*,paginated=True):
+    with open(txt_filename,"w",encoding='utf-8') as flo:
+        render(iter_paragraphs(xdownplay),
+               "pages" if paginated else "text",flo)
+
+def save_screenplay_as_pdf(xdownplay,pdf_filename,*,cache=None):
+    with open(pdf_filename,"wb") as flo:
+        render(iter_paragraphs(xdownplay),"pdf",flo,cache=cache)
+
+def save_screenplay_as_fountain(xdownplay,fountain_filename):
+    with open(fountain_filename,"w",encoding='utf-8') as flo:
+        render(iter_paragraphs(xdownplay),"fountain",flo)
+
+def iter_paragraphs(xdownplay):
+    for xp in xdownplay.findall('p'):
+        yield xp.attrib.get("style","ACTION"), xp.text or ""
+
+
+class DownplayFormatError(ValueError):
+
+    def __init__(self,filename,problems):
+        self.filename = filename
+        self.problems = problems
+        super().__init__("\n".join(self.messages()))
+
+    def messages(self,limit=None):
+        messages = [ "%s:%d:%d: %s" % (self.filename,line,column,message)
+                     for line,column,message in self.problems[:limit] ]
+        if limit is not None and len(self.problems) > limit:
+            messages.append("...and %d more" % (len(self.problems)-limit))
+        return messages
+
+def read_downplay(filename):
+    # Parses and validates a Downplay file in a single pass with expat,
+    # returning its paragraphs.  Every problem found is reported, with
+    # its line and column, in one DownplayFormatError.
+    def problem(message):
+        problems.append((parser.CurrentLineNumber,
+                         parser.CurrentColumnNumber+1,message))
+    def start_element(tag,attrib):
+        nonlocal depth, style, text
+        depth += 1
+        if depth == 1:
+            if tag != "downplay":
+                problem("root element is <%s>, not <downplay>" % tag)
+            elif "format" not in attrib:
+                problem("<downplay> has no format attribute")
+            elif attrib["format"] != "1.0":
+                problem("unsupported Downplay format %s" % attrib["format"])
+        elif depth == 2:
+            if tag != "p":
+                problem("unexpected element <%s>" % tag)
+                return
+            style = attrib.get("style","ACTION")
+            if style not in STYLE_FORMATS:
+                problem("unknown style %r" % style)
+            text = []
+        else:
+            problem("unexpected element <%s> inside a paragraph" % tag)
+    def end_element(tag):
+        nonlocal depth, text
+        if depth == 2 and text is not None:
+            paragraphs.append((style,"".join(text)))
+            text = None
+        depth -= 1
+    def character_data(data):
+        if depth == 2 and text is not None:
+            text.append(data)
+    paragraphs = []
+    problems = []
+    depth = 0
+    style = None
+    text = None
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    with open(filename,"rb") as flo:
+        try:
+            parser.ParseFile(flo)
+        except xml.parsers.expat.ExpatError as exc:
+            problems.append((exc.lineno,exc.offset+1,
+                             xml.parsers.expat.ErrorString(exc.code)))
+    if problems:
+        raise DownplayFormatError(filename,problems)
+    return paragraphs
+
+
+# Fountain (https://fountain.io) support.  Both directions work a line
+# at a time, so memory use doesn't depend on the size of the script.
+# Only what Downplay can represent survives: title pages, notes,
+# boneyard, sections, synopses and page breaks are dropped on import,
+# and emphasis markup is reduced to plain text.
+
+FOUNTAIN_TITLE_KEY_RE = re.compile(
+    r"(title|credit|authors?|source|draft date|date|contact|copyright"
+    r"|notes|revision)\s*:",re.I)
+FOUNTAIN_NOTE_RE = re.compile(r"\[\[.*?\]\]")
+FOUNTAIN_EMPHASIS_RE = re.compile(r"(?<!\\)(\*{1,3}|_)(?=\S)(.+?)(?<=[^\s\\])\1")
+FOUNTAIN_ESCAPE_RE = re.compile(r"\\([*_\\])|^\\([#=(])")
+
+# Characters that give a line special meaning at its start
+FOUNTAIN_MARKERS = "!.@>~#="
+
+def is_fountain_character(text):
+    name = text.split("(",1)[0]
+    return name.upper() == name and any(c.isalpha() for c in name)
+
+def is_fountain_transition(text):
+    return text.upper() == text and text.endswith("TO:")
+
+def iter_fountain_lines(flo):
+    first = True
+    in_title_page = False
+    in_boneyard = False
+    for line in flo:
+        line = line.rstrip("\r\n")
+        if first:
+            first = False
+            in_title_page = FOUNTAIN_TITLE_KEY_RE.match(line) is not None
+        if in_title_page:
+            in_title_page = line.strip() != ""
+            continue
+        if in_boneyard:
+            end = line.find("*/")
+            if end == -1:
+                continue
+            line = line[end+2:]
+            in_boneyard = False
+            if line.strip() == "":
+                continue
+        start = line.find("/*")
+        while start != -1:
+            end = line.find("*/",start+2)
+            if end == -1:
+                line = line[:start]
+                in_boneyard = True
+                break
+            line = line[:start] + line[end+2:]
+            start = line.find("/*")
+        line = FOUNTAIN_NOTE_RE.sub("",line)
+        stripped = line.strip()
+        if stripped.startswith("#") or stripped.startswith("="):
+            # Sections and synopses
+            continue
+        if in_boneyard and stripped == "":
+            continue
+        yield line
+
+def read_fountain(flo):
+    def clean(text):
+        text = FOUNTAIN_EMPHASIS_RE.sub(r"\2",text.strip())
+        return FOUNTAIN_ESCAPE_RE.sub(r"\1\2",text)
+    lines = iter_fountain_lines(flo)
+    line = next(lines,None)
+    started = False
+    pending_blank = False
+    in_dialogue = False
+    previous_blank = True
+    while line is not None:
+        next_line = next(lines,None)
+        stripped = line.strip()
+        following_blank = next_line is None or next_line.strip() == ""
+        if stripped == "":
+            pending_blank = started
+            in_dialogue = False
+            previous_blank = True
+            line = next_line
+            continue
+        if in_dialogue:
+            if stripped.startswith("(") and stripped.endswith(")"):
+                style = "PARENTHETICAL"
+            else:
+                style = "DIALOGUE"
+        elif stripped.startswith("!"):
+            style,stripped = "ACTION",stripped[1:]
+        elif stripped.startswith(".") and not stripped.startswith(".."):
+            style,stripped = "ACTION",stripped[1:]
+        elif stripped.startswith("~"):
+            style,stripped = "ACTION",stripped[1:]
+        elif previous_blank and SCENE_HEADING_RE.match(stripped):
+            style = "ACTION"
+        elif stripped.startswith(">") and stripped.endswith("<"):
+            style,stripped = "ACTION",stripped[1:-1]
+        elif stripped.startswith(">"):
+            style,stripped = "TRANSITION",stripped[1:]
+        elif previous_blank and following_blank \
+             and is_fountain_transition(stripped):
+            style = "TRANSITION"
+        elif previous_blank and not following_blank \
+             and (stripped.startswith("@") or is_fountain_character(stripped)):
+            style = "NAME"
+            if stripped.startswith("@"):
+                stripped = stripped[1:]
+            stripped = stripped.rstrip("^")
+            in_dialogue = True
+        else:
+            style = "ACTION"
+        if pending_blank:
+            yield "ACTION", ""
+            pending_blank = False
+        yield style, clean(stripped)
+        started = True
+        previous_blank = False
+        line = next_line
+
+def write_fountain(paragraphs,flo):
+    previous = None
+    for style,text in paragraphs:
+        text = " ".join(text.split())
+        if text == "":
+            flo.write("\n")
+            previous = None
+            continue
+        text = re.sub(r"([*_\\])",r"\\\1",text)
+        heading = is_scene_heading(style,text)
+        if previous is not None and (
+                heading or style in ("NAME","TRANSITION")
+                or previous == "TRANSITION"
+                or (previous in ("NAME","PARENTHETICAL","DIALOGUE")
+                    and style not in ("PARENTHETICAL","DIALOGUE"))):
+            flo.write("\n")
+        if heading:
+            line = text
+        elif style == "ACTION":
+            if text[:1] in FOUNTAIN_MARKERS + "(" \
+               or is_fountain_character(text) \
+               or FOUNTAIN_TITLE_KEY_RE.match(text) \
+               or SCENE_HEADING_RE.match(text):
+                line = "!" + text
+            else:
+                line = text
+        elif style == "NAME":
+            if is_fountain_character(text) \
+               and text[:1] not in FOUNTAIN_MARKERS \
+               and not SCENE_HEADING_RE.match(text):
+                line = text
+            else:
+                line = "@" + text
+        elif style == "PARENTHETICAL":
+            if text.startswith("(") and text.endswith(")"):
+                line = text
+            else:
+                line = "(%s)" % text
+        elif style == "DIALOGUE":
+            # Inside dialogue only sections, synopses and parentheticals
+            # are recognized
+            if text[:1] in "#=(":
+                line = "\\" + text
+            else:
+                line = text
+        elif style == "TRANSITION":
+            if is_fountain_transition(text) \
+               and text[:1] not in FOUNTAIN_MARKERS \
+               and not SCENE_HEADING_RE.match(text):
+                line = text
+            else:
+                line = ">" + text
+        else:
+            assert False
+        flo.write(line + "\n")
+        previous = style
+
+
+RENDERERS = {
+    'text': write_text,
+    'pages': write_pages,
+    'pdf': write_pdf,
+    'fountain': write_fountain,
+    }
+
+
+class ScriptHighlighter(QtGui.QSyntaxHighlighter):
+
+    # Each block's state is the index of what it was highlighted as.  It
+    # depends only on the block itself, so when a block is edited Qt
+    # sees the state is unchanged and stops there instead of carrying on
+    # through the rest of the document.
+    STATES = ('ACTION','SCENE','DIALOGUE','PARENTHETICAL','NAME','TRANSITION')
+
+    # Elements that ought to fit on a single formatted line
+    SINGLE_LINE_STATES = ('SCENE','NAME','TRANSITION')
+
+    def __init__(self,document=None):
+        super().__init__(document)
+
+        self.formats = {}
+
+        scene_format = QtGui.QTextCharFormat()
+        scene_format.setFontWeight(QtGui.QFont.Bold)
+        scene_format.setFontUnderline(True)
+        self.formats['SCENE'] = scene_format
+
+        name_format = QtGui.QTextCharFormat()
+        name_format.setFontWeight(QtGui.QFont.Bold)
+        self.formats['NAME'] = name_format
+
+        parenthetical_format = QtGui.QTextCharFormat()
+        parenthetical_format.setFontItalic(True)
+        parenthetical_format.setForeground(QtGui.QColor(96,96,96))
+        self.formats['PARENTHETICAL'] = parenthetical_format
+
+        self.overlong_format = QtGui.QTextCharFormat()
+        self.overlong_format.setBackground(QtGui.QColor(255,200,200))
+
+        self.folded_format = QtGui.QTextCharFormat()
+        self.folded_format.setBackground(QtGui.QColor(224,224,224))
+
+    def highlightBlock(self,text):
+        left_margin = self.currentBlock().blockFormat().leftMargin()
+        style = ScriptEdit.REV_MARGINS.get(left_margin,'ACTION')
+        if is_scene_heading(style,text):
+            state = 'SCENE'
+        else:
+            state = style
+        self.setCurrentBlockState(self.STATES.index(state))
+        char_format = self.formats.get(state)
+        if state == 'SCENE':
+            next_block = self.currentBlock().next()
+            if next_block.isValid() and not next_block.isVisible():
+                char_format = QtGui.QTextCharFormat(char_format)
+                char_format.merge(self.folded_format)
+        if char_format is not None:
+            self.setFormat(0,len(text),char_format)
+        if state in self.SINGLE_LINE_STATES:
+            indent,width = STYLE_FORMATS[style]
+            length = len(text.rstrip())
+            if length > width:
+                self.setFormat(width,length-width,self.overlong_format)
+
+
+class DocumentStatistics:
+
+    # Word counts, formatted line counts and scene heading flags for each
+    # block, in lists indexed by block number.  Each contentsChange
+    # recomputes only the blocks it touched and splices them into the
+    # lists, so the totals are always current without rescanning the
+    # document.  Prefix sums of the line counts and scene flags, for the
+    # page and scene at the cursor, are cached and cut back to the first
+    # changed block on each update; a query extends them only as far as
+    # it needs, so typing and querying near the same place costs the
+    # same in any size of document.
+
+    LINES_PER_PAGE = 52
+
+    def __init__(self,document):
+        self.document = document
+        self.reset()
+        document.contentsChange.connect(self.update)
+
+    def reset(self):
+        self.words = []
+        self.lines = []
+        self.scenes = []
+        self.word_count = 0
+        self.line_count = 0
+        self.scene_count = 0
+        self.line_sums = [0]
+        self.scene_sums = [0]
+        self.update(0,0,self.document.characterCount())
+
+    def block_statistics(self,block):
+        left_margin = block.blockFormat().leftMargin()
+        style = ScriptEdit.REV_MARGINS.get(left_margin,'ACTION')
+        text = block.text()
+        if text == "":
+            n_lines = 1
+        else:
+            n_lines = len(format_paragraph(text,*STYLE_FORMATS[style]))
+        return len(text.split()), n_lines, int(is_scene_heading(style,text))
+
+    def update(self,position,removed,added):
+        document = self.document
+        first = document.findBlock(position)
+        if not first.isValid():
+            first = document.lastBlock()
+        last = document.findBlock(position+added)
+        if not last.isValid():
+            last = document.lastBlock()
+        # The changed blocks replace however many blocks it takes to
+        # make the block count come out right
+        n_added = document.blockCount() - len(self.words)
+        start = first.blockNumber()
+        stop = max(last.blockNumber()+1,start+n_added)
+        while last.blockNumber() < stop-1:
+            last = last.next()
+        words = []
+        lines = []
+        scenes = []
+        block = first
+        while True:
+            n_words,n_lines,n_scenes = self.block_statistics(block)
+            words.append(n_words)
+            lines.append(n_lines)
+            scenes.append(n_scenes)
+            if block == last:
+                break
+            block = block.next()
+        old_stop = stop - n_added
+        self.word_count += sum(words) - sum(self.words[start:old_stop])
+        self.line_count += sum(lines) - sum(self.lines[start:old_stop])
+        self.scene_count += sum(scenes) - sum(self.scenes[start:old_stop])
+        del self.line_sums[start+1:]
+        del self.scene_sums[start+1:]
+        self.words[start:old_stop] = words
+        self.lines[start:old_stop] = lines
+        self.scenes[start:old_stop] = scenes
+
+    @staticmethod
+    def prefix_sum(sums,values,n):
+        # sums[i] is the sum of values[:i]
+        while len(sums) <= n:
+            sums.append(sums[-1] + values[len(sums)-1])
+        return sums[n]
+
+    def scene_number(self,block_number):
+        return self.prefix_sum(self.scene_sums,self.scenes,block_number+1)
+
+    def page_number(self,block_number):
+        n_lines = self.prefix_sum(self.line_sums,self.lines,block_number)
+        return n_lines // self.LINES_PER_PAGE + 1
+
+    def page_count(self):
+        return -(-self.line_count // self.LINES_PER_PAGE)
+
+
 class ScriptEdit(QtWidgets.QTextEdit):
 
     MARGINS = {
@@ -194,11 +967,13 @@ class ScriptEdit(QtWidgets.QTextEdit):
 
     statusChanged = QtCore.Signal(str)
 
-    def __init__(self,parent=None):
+    def __init__(self,parent=None,status_interval=100):
         super().__init__(parent)
 
+        # Status updates are throttled: the first event in a burst starts
+        # the timer and the rest are absorbed until it fires
         self.changed_timer = QtCore.QTimer(self)
-        self.changed_timer.setInterval(0)
+        self.changed_timer.setInterval(status_interval)
         self.changed_timer.setSingleShot(True)
         self.changed_timer.timeout.connect(self.emit_status_change)
 
@@ -224,6 +999,10 @@ class ScriptEdit(QtWidgets.QTextEdit):
         self.export_as_pdf_action = self.create_action(
             "Export as PDF...", None, self.export_as_pdf,
             enabled=HAS_REPORTLAB)
+        self.export_as_fountain_action = self.create_action(
+            "Export as Fountain...", None, self.export_as_fountain)
+        self.import_fountain_action = self.create_action(
+            "&Import Fountain...", None, self.import_fountain)
         self.print_to_console_action = self.create_action(
             "Print to console", None, self.print_to_console)
 
@@ -256,6 +1035,17 @@ class ScriptEdit(QtWidgets.QTextEdit):
         self.cycle_styles_action = self.create_action(
             "Cycle &Styles", Qt.Key_Tab | Qt.NoModifier,
             self.cycle_margin)
+        self.highlighting_action = self.create_action(
+            "Syntax &Highlighting", None, self.set_highlighting,
+            checked=True)
+
+        self.fold_scene_action = self.create_action(
+            "&Fold Scene", Qt.Key_Period | Qt.CTRL, self.toggle_scene_fold)
+        self.fold_all_action = self.create_action(
+            "Fold &All Scenes", None, lambda: self.set_all_scenes_folded(True))
+        self.unfold_all_action = self.create_action(
+            "&Unfold All Scenes", None,
+            lambda: self.set_all_scenes_folded(False))
 
         self.estimate_pages_action = self.create_action(
             "Estimate number of &Pages", None, self.estimate_pages)
@@ -272,10 +1062,15 @@ class ScriptEdit(QtWidgets.QTextEdit):
         text_option.setWrapMode(QtGui.QTextOption.WrapAtWordBoundaryOrAnywhere)
         self.document().setDefaultTextOption(text_option)
 
+        self.highlighter = ScriptHighlighter(self.document())
+        self.statistics = DocumentStatistics(self.document())
+
         self.last_dirname = None
         self.current_filename = None
+        self.page_cache = None
 
         self.enable_signals()
+        self.cursorPositionChanged.connect(self.reveal_cursor)
 
         self.new()
 
@@ -286,28 +1081,22 @@ class ScriptEdit(QtWidgets.QTextEdit):
             super().keyPressEvent(event)
 
     def enable_signals(self):
-        QtCore.QObject.connect(self.document(),
-                               QtCore.SIGNAL("modificationChanged(bool)"),
-                               self.changed_timer,
-                               QtCore.SLOT("start()"))
-        QtCore.QObject.connect(self,
-                               QtCore.SIGNAL("cursorPositionChanged()"),
-                               self.changed_timer,
-                               QtCore.SLOT("start()"))
+        self.document().modificationChanged.connect(
+            self.request_status_change)
+        self.cursorPositionChanged.connect(self.request_status_change)
 
     def disable_signals(self):
-        QtCore.QObject.disconnect(self.document(),
-                                  QtCore.SIGNAL("modificationChanged(bool)"),
-                                  self.changed_timer,
-                                  QtCore.SLOT("start()"))
-        QtCore.QObject.disconnect(self,
-                                  QtCore.SIGNAL("cursorPositionChanged()"),
-                                  self.changed_timer,
-                                  QtCore.SLOT("start()"))
-
-    def create_action(self,label,shortcut=None,function=None,enabled=True):
+        self.document().modificationChanged.disconnect(
+            self.request_status_change)
+        self.cursorPositionChanged.disconnect(self.request_status_change)
+
+    def create_action(self,label,shortcut=None,function=None,enabled=True,
+                      checked=None):
         action = QtWidgets.QAction(label,self)
         action.setEnabled(enabled)
+        if checked is not None:
+            action.setCheckable(True)
+            action.setChecked(checked)
         if shortcut is not None:
             action.setShortcut(shortcut)
         if function is not None:
@@ -321,7 +1110,7 @@ class ScriptEdit(QtWidgets.QTextEdit):
         block_format.setLeftMargin(left_margin)
         block_format.setRightMargin(right_margin)
         cursor.setBlockFormat(block_format)
-        self.changed_timer.start()
+        self.request_status_change()
 
     def get_margin_type(self):
         cursor = self.textCursor()
@@ -338,6 +1127,81 @@ class ScriptEdit(QtWidgets.QTextEdit):
         else:
             self.set_margin_type('ACTION')
 
+    def set_highlighting(self,enabled):
+        if enabled:
+            self.highlighter.setDocument(self.document())
+        else:
+            self.highlighter.setDocument(None)
+
+    # Folding a scene hides the blocks after its heading.  Qt doesn't lay
+    # out hidden blocks at all, so a mostly folded document is about as
+    # cheap to edit as a short one.  Visibility is not part of the block
+    # format or text, so it never ends up in the saved or exported file.
+
+    def is_scene_heading_block(self,block):
+        left_margin = block.blockFormat().leftMargin()
+        margin_type = self.REV_MARGINS.get(left_margin,'ACTION')
+        return is_scene_heading(margin_type,block.text())
+
+    def find_scene_heading(self,block):
+        while block.isValid() and not self.is_scene_heading_block(block):
+            block = block.previous()
+        return block
+
+    def set_scene_folded(self,heading,folded):
+        first = block = heading.next()
+        while block.isValid() and not self.is_scene_heading_block(block):
+            block.setVisible(not folded)
+            last = block
+            block = block.next()
+        if block != first:
+            start = first.position()
+            self.document().markContentsDirty(
+                start,last.position()+last.length()-start)
+        self.highlighter.rehighlightBlock(heading)
+
+    def toggle_scene_fold(self):
+        heading = self.find_scene_heading(self.textCursor().block())
+        if not heading.isValid():
+            return
+        next_block = heading.next()
+        folded = next_block.isValid() and not next_block.isVisible()
+        if not folded:
+            cursor = self.textCursor()
+            cursor.setPosition(heading.position())
+            self.setTextCursor(cursor)
+        self.set_scene_folded(heading,not folded)
+
+    def set_all_scenes_folded(self,folded):
+        if folded:
+            heading = self.find_scene_heading(self.textCursor().block())
+            if heading.isValid():
+                cursor = self.textCursor()
+                cursor.setPosition(heading.position())
+                self.setTextCursor(cursor)
+        headings = []
+        block = self.document().firstBlock()
+        while block.isValid():
+            if self.is_scene_heading_block(block):
+                headings.append(block)
+                block.setVisible(True)
+            else:
+                block.setVisible(not (folded and headings))
+            block = block.next()
+        self.document().markContentsDirty(
+            0,self.document().characterCount())
+        for heading in headings:
+            self.highlighter.rehighlightBlock(heading)
+
+    def reveal_cursor(self):
+        block = self.textCursor().block()
+        if not block.isVisible():
+            heading = self.find_scene_heading(block)
+            if heading.isValid():
+                self.set_scene_folded(heading,False)
+            else:
+                self.set_all_scenes_folded(False)
+
     def find_in_document(self,find_text,flags=QtGui.QTextDocument.FindFlag()):
         status = self.find(find_text,QtGui.QTextDocument.FindFlag(flags))
         if status:
@@ -395,12 +1259,12 @@ class ScriptEdit(QtWidgets.QTextEdit):
         filename = os.path.normpath(os.path.abspath(filename))
         basename = os.path.basename(filename)
         try:
-            with open(filename,"rb") as flo:
-                doc = ET.parse(flo)
-        except ET.ParseError:
+            paragraphs = read_downplay(filename)
+        except DownplayFormatError as exc:
             QtWidgets.QMessageBox.warning(
-                self,"Invalid XML",
-                "The file %s contained invalid XML" % basename)
+                self,"File format error",
+                "File %s is not a valid Downplay file:\n%s"
+                % (basename, "\n".join(exc.messages(limit=10))))
             return
         except Exception as exc:
             if isinstance(exc,IOError) and exc.errno == 2:
@@ -414,48 +1278,82 @@ class ScriptEdit(QtWidgets.QTextEdit):
                     "following error message:\n%s"
                     % (basename, traceback.format_exc()))
             return
-        xdownplay = doc.getroot()
-        if xdownplay.tag != "downplay" \
-           or xdownplay.attrib.get("format") is None:
+        self.load_paragraphs(paragraphs)
+        self.current_filename = filename
+        self.last_dirname = os.path.dirname(filename)
+        self.document().setModified(False)
+        self.request_status_change()
+
+    def import_fountain(self):
+        if not self.ok_to_discard():
+            return
+        if self.last_dirname is not None:
+            start_dirname = self.last_dirname
+        else:
+            start_dirname = os.getcwd()
+        new_filename,filter = QtWidgets.QFileDialog.getOpenFileName(
+            self,"Import Fountain file...",start_dirname,
+            "Fountain files (*.fountain);;All files (*)")
+        if new_filename != "":
+            self.import_fountain_filename(new_filename)
+
+    def import_fountain_filename(self,filename):
+        filename = os.path.normpath(os.path.abspath(filename))
+        basename = os.path.basename(filename)
+        # Read the whole file before touching the document, so that a
+        # failed import leaves the current script and filename alone
+        try:
+            with open(filename,"r",encoding='utf-8') as flo:
+                paragraphs = list(read_fountain(flo))
+        except UnicodeDecodeError as exc:
             QtWidgets.QMessageBox.warning(
-                self,"File format error",
-                "File %s not a Downplay file" % basename)
+                self,"File error",
+                "File %s is not UTF-8 encoded text: %s" % (basename, exc))
             return
-        format = xdownplay.attrib["format"]
-        if format != "1.0":
+        except Exception:
             QtWidgets.QMessageBox.warning(
-                self,"File format error",
-                "File %s has unsupported Downplay format %s"
-                % (basename, format))
+                self,"File error",
+                "Error reading file %s; runtime returned the "
+                "following error message:\n%s"
+                % (basename, traceback.format_exc()))
             return
-        for xp in xdownplay:
-            if xp.tag != "p" or len(xp) != 0 \
-               or xp.attrib.get("style","ACTION") not in self.MARGINS:
-                QtWidgets.QMessageBox.warning(
-                    self,"File format error",
-                    "File %s has unsupported Downplay has invalid elements"
-                    % (basename, format))
-                return
+        self.load_paragraphs(paragraphs)
+        self.current_filename = None
+        self.last_dirname = os.path.dirname(filename)
+        self.document().setModified(True)
+        self.request_status_change()
+
+    def load_paragraphs(self,paragraphs):
+        # Builds the whole document in one edit block with undo turned
+        # off, rather than one undoable style change per paragraph
+        block_formats = {}
+        document = self.document()
         self.disable_signals()
+        document.setUndoRedoEnabled(False)
         try:
-            cursor = self.textCursor()
+            document.clear()
+            cursor = QtGui.QTextCursor(document)
+            cursor.beginEditBlock()
             first = True
-            for xp in xdownplay:
-                margin_type = xp.attrib.get("style","ACTION")
+            for margin_type,text in paragraphs:
+                block_format = block_formats.get(margin_type)
+                if block_format is None:
+                    left_margin,right_margin = self.MARGINS[margin_type]
+                    block_format = cursor.blockFormat()
+                    block_format.setLeftMargin(left_margin)
+                    block_format.setRightMargin(right_margin)
+                    block_formats[margin_type] = block_format
                 if first:
-                    self.clear()
+                    cursor.setBlockFormat(block_format)
                     first = False
                 else:
-                    cursor.insertBlock()
-                self.set_margin_type(margin_type)
-                cursor.insertText(xp.text)
+                    cursor.insertBlock(block_format)
+                cursor.insertText(text)
+            cursor.endEditBlock()
             self.moveCursor(QtGui.QTextCursor.Start)
         finally:
+            document.setUndoRedoEnabled(True)
             self.enable_signals()
-        self.current_filename = filename
-        self.last_dirname = os.path.dirname(filename)
-        self.document().setModified(False)
-        self.changed_timer.start()
 
     def extract_xml(self):
         xdownplay = ET.Element("downplay")
@@ -540,7 +1438,7 @@ class ScriptEdit(QtWidgets.QTextEdit):
             self.current_filename = filename
             self.last_dirname = os.path.dirname(filename)
             self.document().setModified(False)
-            self.changed_timer.start()
+            self.request_status_change()
 
     def export_as_text(self):
         self.export_as_text_common(False)
@@ -592,7 +1490,33 @@ class ScriptEdit(QtWidgets.QTextEdit):
                 if ext == "":
                     new_filename = "%s.pdf" % stub
             xdownplay,warnings = self.extract_xml()
-            save_screenplay_as_pdf(xdownplay,new_filename)
+            if self.page_cache is not None:
+                before = self.page_cache.statistics()
+            save_screenplay_as_pdf(xdownplay,new_filename,
+                                   cache=self.page_cache)
+            if self.page_cache is not None:
+                self.page_cache.log_statistics(before)
+
+    def export_as_fountain(self):
+        if self.last_dirname is not None:
+            start_dirname = self.last_dirname
+        else:
+            start_dirname = os.getcwd()
+        if self.current_filename is not None:
+            stub,ext = os.path.splitext(self.current_filename)
+            start_pathname = os.path.join(start_dirname,stub+".fountain")
+        else:
+            start_pathname = start_dirname
+        new_filename,filter = QtWidgets.QFileDialog.getSaveFileName(
+            self,"Export buffer as Fountain file...",start_pathname,
+            "Fountain files (*.fountain);;All files (*)")
+        if new_filename != "":
+            if filter == "Fountain files (*.fountain)":
+                stub,ext = os.path.splitext(new_filename)
+                if ext == "":
+                    new_filename = "%s.fountain" % stub
+            xdownplay,warnings = self.extract_xml()
+            save_screenplay_as_fountain(xdownplay,new_filename)
 
     def print_to_console(self):
         print("-"*79)
@@ -601,25 +1525,36 @@ class ScriptEdit(QtWidgets.QTextEdit):
         print("-"*79)
 
     def estimate_pages(self):
-        lines_per_page = 52
-        xdownplay,warnings = self.extract_xml()
-        text = format_screenplay(xdownplay)
-        n_lines = text.count("\n")
-        n_pages = n_lines / 52
+        lines_per_page = DocumentStatistics.LINES_PER_PAGE
+        n_pages = self.statistics.line_count / lines_per_page
         QtWidgets.QMessageBox.information(
             self,"Page count estimate",
             "Page count estimated at %g, based on %g lines per page."
             % (n_pages, lines_per_page))
 
+    def request_status_change(self):
+        if not self.changed_timer.isActive():
+            self.changed_timer.start()
+
     def emit_status_change(self):
+        start = time.perf_counter()
         self.statusChanged.emit(self.get_status_line())
+        logger.debug("status update took %.3f ms with %d blocks",
+                     (time.perf_counter()-start)*1000,
+                     self.document().blockCount())
 
     def get_status_line(self):
-        return "%s%s        %s" % (
+        statistics = self.statistics
+        block_number = self.textCursor().blockNumber()
+        return "%s%s        %s        Scene %d  Page %d/%d  %d words" % (
             (os.path.basename(self.current_filename)
              if self.current_filename is not None else "Untitled"),
             ("*" if self.document().isModified() else ""),
-            self.get_margin_type())
+            self.get_margin_type(),
+            statistics.scene_number(block_number),
+            statistics.page_number(block_number),
+            statistics.page_count(),
+            statistics.word_count)
 
 
     _keepalive = []
@@ -756,10 +1691,11 @@ def populate_menu(menu,menu_def):
             def_error()
 
 
-def gui(filename=None):
+def gui(filename=None,status_interval=100,cache=None):
     app = QtWidgets.QApplication([])
 
-    script_edit = ScriptEdit()
+    script_edit = ScriptEdit(status_interval=status_interval)
+    script_edit.page_cache = cache
     if filename is not None:
         script_edit.open_filename(filename)
 
@@ -779,9 +1715,12 @@ def gui(filename=None):
             script_edit.save_as_action,
             script_edit.save_a_copy_action,
             "-",
+            script_edit.import_fountain_action,
+            "-",
             script_edit.export_as_text_action,
             script_edit.export_as_pages_action,
             script_edit.export_as_pdf_action,
+            script_edit.export_as_fountain_action,
             script_edit.print_to_console_action,
             "-",
             ( "&Quit", Qt.Key_F4 | Qt.ALT, sys.exit ),
@@ -807,6 +1746,14 @@ def gui(filename=None):
             script_edit.parenthetical_style_action,
             script_edit.name_style_action,
             script_edit.transition_style_action,
+            "-",
+            script_edit.highlighting_action,
+            ),
+        ),
+        ( '&View', None, (
+            script_edit.fold_scene_action,
+            script_edit.fold_all_action,
+            script_edit.unfold_all_action,
             ),
         ),
         ( '&Info', None, (
@@ -831,34 +1778,150 @@ def gui(filename=None):
     app.exec_()
 
 
-def convert(downplay_filenames,output_filename):
-    xdownplay = ET.Element('downplay',format="1.0")
-    for i,filename in enumerate(downplay_filenames):
-        if not filename.endswith('.dply'):
-            raise RuntimeError('input filenames must all be downplay files')
-        if i != 0:
-            ET.SubElement(xdownplay,'p',style='ACTION')
-        xsdp = ET.parse(filename).getroot()
-        xdownplay.extend(xsdp[:])
+def read_screenplay(filename):
+    if filename.endswith('.fountain'):
+        with open(filename,"r",encoding='utf-8') as flo:
+            yield from read_fountain(flo)
+    else:
+        yield from read_downplay(filename)
+
+def check(input_filenames):
+    # Parses and validates without formatting anything; returns whether
+    # every file was valid
+    ok = True
+    for filename in input_filenames:
+        try:
+            for paragraph in read_screenplay(filename):
+                pass
+        except DownplayFormatError as exc:
+            print(exc,file=sys.stderr)
+            ok = False
+        except ValueError as exc:
+            # Including UnicodeDecodeError from a Fountain file that
+            # is not UTF-8
+            print("%s: %s" % (filename,exc),file=sys.stderr)
+            ok = False
+        except OSError as exc:
+            print("%s: %s" % (filename,exc.strerror),file=sys.stderr)
+            ok = False
+    return ok
+
+def convert(input_filenames,output_filename,cache=None,shard_at=None,
+            jobs=None):
+    for filename in input_filenames:
+        if not filename.endswith(('.dply','.fountain')):
+            raise RuntimeError('input filenames must all be downplay '
+                               'or fountain files')
+    # Downplay files are validated before any output is written
+    downplay_paragraphs = { filename: read_downplay(filename)
+                            for filename in input_filenames
+                            if filename.endswith('.dply') }
+    def paragraphs():
+        for i,filename in enumerate(input_filenames):
+            if i != 0:
+                yield 'ACTION', ""
+            if filename in downplay_paragraphs:
+                yield from downplay_paragraphs[filename]
+            else:
+                yield from read_screenplay(filename)
     if output_filename.endswith('.pdf'):
         if not HAS_REPORTLAB:
             raise RuntimeError("can't import reportlab")
-        save_screenplay_as_pdf(xdownplay,output_filename)
+        with open(output_filename,"wb") as flo:
+            if shard_at is not None:
+                render_sharded(paragraphs(),"pdf",flo,split_at=shard_at,
+                               max_workers=jobs)
+            else:
+                render(paragraphs(),"pdf",flo,cache=cache)
+        if cache is not None and shard_at is None:
+            cache.log_statistics()
     elif output_filename.endswith('.txt'):
-        save_screenplay_as_text(xdownplay,output_filename)
+        with open(output_filename,"w",encoding='utf-8') as flo:
+            if shard_at is not None:
+                render_sharded(paragraphs(),"pages",flo,split_at=shard_at,
+                               max_workers=jobs)
+            else:
+                render(paragraphs(),"pages",flo)
+    elif shard_at is not None:
+        raise RuntimeError('sharded output must be text or PDF')
+    elif output_filename.endswith('.fountain'):
+        with open(output_filename,"w",encoding='utf-8') as flo:
+            render(paragraphs(),"fountain",flo)
     else:
-        raise RuntimeError('out filenames must all be text or PDF')
+        raise RuntimeError('out filenames must all be text, PDF or fountain')
+
+
+def report_file(filename):
+    paragraphs = list(read_screenplay(filename))
+    sources = []
+    text = paginate_screenplay_lines(paragraphs,sources)
+    report = report_screenplay(paragraphs,text,sources)
+    report["file"] = filename
+    return report
+
+REPORT_CSV_FIELDS = ( "file", "record", "scene", "heading", "page", "line",
+                      "eighths", "length", "characters", "character",
+                      "cues", "dialogue_lines" )
+
+def breakdown(input_filenames,output_filename):
+    # Each script is paginated once, in its own process
+    for filename in input_filenames:
+        if not filename.endswith(('.dply','.fountain')):
+            raise RuntimeError('input filenames must all be downplay '
+                               'or fountain files')
+    if not output_filename.endswith(('.csv','.json')):
+        raise RuntimeError('report filename must be CSV or JSON')
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        reports = list(executor.map(report_file,input_filenames))
+    with open(output_filename,"w",encoding='utf-8',newline="") as flo:
+        if output_filename.endswith('.json'):
+            for report in reports:
+                for scene in report["scenes"]:
+                    scene["length"] = format_eighths(scene["eighths"])
+            json.dump(reports,flo,indent=2)
+            flo.write("\n")
+            return
+        writer = csv.DictWriter(flo,REPORT_CSV_FIELDS)
+        writer.writeheader()
+        for report in reports:
+            for scene in report["scenes"]:
+                writer.writerow(dict(
+                    scene,file=report["file"],record="scene",
+                    length=format_eighths(scene["eighths"]),
+                    characters="; ".join(scene["characters"])))
+            for counts in report["characters"]:
+                writer.writerow(dict(
+                    counts,file=report["file"],record="character"))
 
 
 def main():
     ap = argparse.ArgumentParser(description='Invoke Downplay')
     ap.add_argument("filename",default=None,nargs='?',help='File to open')
-    ap.add_argument("--convert",default=None,nargs='*',metavar="FILENAME",help="Convert a downplay flies to a PDF/TXT file")
+    ap.add_argument("--convert",default=None,nargs='*',metavar="FILENAME",help="Convert downplay or fountain files to a PDF/TXT/fountain file")
+    ap.add_argument("--report",default=None,nargs='*',metavar="FILENAME",help="Write a scene and character breakdown of downplay or fountain files to a CSV/JSON file")
+    ap.add_argument("--shard-at",default=None,choices=sorted(SHARD_BOUNDARIES),help="With --convert, start each scene or act on a new page and render them in parallel")
+    ap.add_argument("--jobs",default=None,type=int,metavar="N",help="Number of worker processes for --shard-at (default: one per CPU)")
+    ap.add_argument("--check",default=None,nargs='*',metavar="FILENAME",help="Check downplay or fountain files for errors without converting them")
+    ap.add_argument("--status-interval",default=100,type=int,metavar="MS",help="Minimum time between status bar updates (default 100)")
+    ap.add_argument("--cache-dir",default=None,metavar="DIRNAME",help="Cache rendered PDF pages in this directory")
+    ap.add_argument("--cache-size",default=64,type=int,metavar="MB",help="Maximum size of the page cache (default 64)")
+    ap.add_argument("--verbose",action='store_true',help="Log debugging information, such as status update timings")
     args = ap.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    if args.cache_dir is not None:
+        cache = PageCache(args.cache_dir,args.cache_size*1024*1024)
+    else:
+        cache = None
     if args.convert is not None:
-        convert(args.convert[:-1],args.convert[-1])
+        convert(args.convert[:-1],args.convert[-1],cache,args.shard_at,
+                args.jobs)
+    elif args.report is not None:
+        breakdown(args.report[:-1],args.report[-1])
+    elif args.check is not None:
+        sys.exit(0 if check(args.check) else 1)
     else:
-        gui(args.filename)
+        gui(args.filename,args.status_interval,cache)
 
 
 if __name__ == '__main__':
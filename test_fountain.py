@@ -0,0 +1,95 @@
+#! /usr/bin/python3
+
+# Round trips through write_fountain and read_fountain must give back
+# the paragraphs written, whatever characters they start with.  Runs
+# under pytest or directly with python.
+
+import io
+
+import downplay
+
+
+SCRIPTS = {
+    "dialogue that looks like sections": [
+        ("NAME","BOB"),
+        ("DIALOGUE","#1 fan of yours."),
+        ("DIALOGUE","== great"),
+        ("ACTION",""),
+        ("TRANSITION","!SMASH CUT TO:"),
+        ],
+    "dialogue that looks like other markup": [
+        ("NAME","ALICE"),
+        ("DIALOGUE","(beat) is not a parenthetical (here)"),
+        ("DIALOGUE",".hi"),
+        ("DIALOGUE","~ la la"),
+        ("DIALOGUE",">centered<"),
+        ("DIALOGUE","!bang @at"),
+        ("DIALOGUE","\\# and \\( and \\*stars\\*"),
+        ],
+    "cues with markers": [
+        ("NAME","!BOB"),
+        ("DIALOGUE","One."),
+        ("ACTION",""),
+        ("NAME","@@AL"),
+        ("PARENTHETICAL","(beat)"),
+        ("DIALOGUE","Two."),
+        ("ACTION",""),
+        ("NAME","#ANNA"),
+        ("DIALOGUE","= yes"),
+        ("ACTION",""),
+        ("NAME",".CAROL"),
+        ("DIALOGUE","Three."),
+        ("ACTION",""),
+        ("NAME",">DAVE"),
+        ("DIALOGUE","Four."),
+        ("ACTION",""),
+        ("NAME","INT. EVE"),
+        ("DIALOGUE","Five."),
+        ],
+    "transitions with markers": [
+        ("ACTION","INT. HOUSE - DAY"),
+        ("ACTION",""),
+        ("TRANSITION","CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION","~CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION",".DISSOLVE TO:"),
+        ("ACTION",""),
+        ("TRANSITION","@CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION","#CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION","=CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION",">CUT TO:"),
+        ("ACTION",""),
+        ("TRANSITION","INT. CUT TO:"),
+        ],
+    "action with markers": [
+        ("ACTION","Title: not a title page"),
+        ("ACTION",""),
+        ("ACTION","#3 on the list."),
+        ("ACTION","= sign"),
+        ("ACTION","(aside)"),
+        ("ACTION","BOB"),
+        ("ACTION","\\(escaped)"),
+        ("ACTION",""),
+        ("ACTION","EXT. ROAD - NIGHT"),
+        ],
+    }
+
+
+def round_trip(paragraphs):
+    flo = io.StringIO()
+    downplay.write_fountain(paragraphs,flo)
+    return list(downplay.read_fountain(io.StringIO(flo.getvalue())))
+
+
+def test_round_trip():
+    for name,paragraphs in SCRIPTS.items():
+        assert round_trip(paragraphs) == paragraphs, name
+
+
+if __name__ == '__main__':
+    test_round_trip()
+    print("%d scripts survived the round trip" % len(SCRIPTS))
@@ -0,0 +1,85 @@
+#! /usr/bin/python3
+
+# Sharded export must produce exactly what render() produces whenever
+# every shard boundary falls at the top of a page.  Runs under pytest or
+# directly with python.
+
+import io
+
+import downplay
+
+
+FORMATS = [ "pages" ]
+if downplay.HAS_REPORTLAB:
+    FORMATS.append("pdf")
+
+
+def scene(number,n_pages,short=0):
+    # A scene heading and enough action to fill n_pages exactly, less
+    # short lines.  The first page holds the heading and 51 lines, each
+    # later page 52 lines.
+    n_lines = 51 + 52*(n_pages-1) - short
+    return [("ACTION","INT. ROOM %d - DAY" % number)] \
+        + [ ("ACTION","Action line %d of scene %d." % (i,number))
+            for i in range(n_lines) ]
+
+def act(name,scenes):
+    return [("ACTION",name)] + [ paragraph for s in scenes for paragraph in s ]
+
+def act_scene(number,n_pages):
+    # Under an act heading the first scene has one line less room
+    return scene(number,n_pages,short=1)
+
+CASES = {
+    # The final shard fills its last page, leaving a blank trailing page
+    "final shard fills its page": ("scene",
+        scene(1,1) + scene(2,1)),
+    "multi-page shards": ("scene",
+        scene(1,2) + scene(2,1) + scene(3,3)),
+    "final shard ends mid-page": ("scene",
+        scene(1,1) + scene(2,2) + scene(3,1,short=20)),
+    "acts fill their pages": ("act",
+        act("ACT ONE",[act_scene(1,1),scene(2,1)])
+        + act("ACT TWO",[act_scene(3,2)])),
+    }
+
+
+def render_both(fmt,split_at,paragraphs):
+    if fmt == "pdf":
+        serial,sharded = io.BytesIO(),io.BytesIO()
+        downplay.render(paragraphs,fmt,serial,invariant=True)
+        downplay.render_sharded(paragraphs,fmt,sharded,split_at=split_at,
+                                max_workers=2,invariant=True)
+    else:
+        serial,sharded = io.StringIO(),io.StringIO()
+        downplay.render(paragraphs,fmt,serial)
+        downplay.render_sharded(paragraphs,fmt,sharded,split_at=split_at,
+                                max_workers=2)
+    return serial.getvalue(),sharded.getvalue()
+
+
+def test_boundaries_fall_on_page_breaks():
+    # The cases are only meaningful if every shard starts a new page
+    for name,(split_at,paragraphs) in CASES.items():
+        sources = []
+        downplay.paginate_screenplay_lines(paragraphs,sources)
+        shards = downplay.split_shards(paragraphs,split_at)
+        starts = []
+        index = 0
+        for shard in shards:
+            starts.append(sources.index(index))
+            index += len(shard)
+        assert all(start % 60 == 4 for start in starts), name
+
+
+def test_sharded_matches_serial():
+    for name,(split_at,paragraphs) in CASES.items():
+        for fmt in FORMATS:
+            serial,sharded = render_both(fmt,split_at,paragraphs)
+            assert sharded == serial, "%s (%s) differs" % (name,fmt)
+
+
+if __name__ == '__main__':
+    test_boundaries_fall_on_page_breaks()
+    test_sharded_matches_serial()
+    print("sharded output matched serial output in %d cases" % len(CASES))
@@ -0,0 +1,73 @@
+#! /usr/bin/python3
+
+# Stress test for render(): hundreds of renders on a thread pool must
+# produce exactly the bytes that the same renders produce one at a time.
+# Runs under pytest or directly with python.
+
+import io
+import random
+import concurrent.futures
+
+import downplay
+
+
+N_RENDERS = 400
+N_THREADS = 32
+
+FORMATS = [ "text", "pages", "fountain" ]
+if downplay.HAS_REPORTLAB:
+    FORMATS.append("pdf")
+
+
+def make_script(seed,n_scenes):
+    rng = random.Random(seed)
+    words = ( "the a man woman runs walks door opens slowly table gun "
+              "letter window rain night α → β ★" ).split()
+    def sentence(n_words):
+        return " ".join(rng.choice(words) for i in range(n_words)) + "."
+    paragraphs = []
+    for i in range(n_scenes):
+        paragraphs.append(("ACTION","INT. PLACE %d - NIGHT" % i))
+        paragraphs.append(("ACTION",""))
+        paragraphs.append(("ACTION",sentence(rng.randint(5,40))))
+        paragraphs.append(("ACTION",""))
+        for j in range(rng.randint(1,4)):
+            paragraphs.append(("NAME",rng.choice(["BOB","ALICE","CAROL"])))
+            if rng.random() < 0.3:
+                paragraphs.append(("PARENTHETICAL","(beat)"))
+            paragraphs.append(("DIALOGUE",sentence(rng.randint(3,80))))
+            paragraphs.append(("ACTION",""))
+        if rng.random() < 0.2:
+            paragraphs.append(("TRANSITION","CUT TO:"))
+            paragraphs.append(("ACTION",""))
+    return paragraphs
+
+SCRIPTS = [ make_script(seed,n_scenes)
+            for seed,n_scenes in ((1,5),(2,40),(3,120)) ]
+
+
+def render_job(job):
+    script,fmt = job
+    if fmt == "pdf":
+        sink = io.BytesIO()
+        downplay.render(SCRIPTS[script],fmt,sink,invariant=True)
+    else:
+        sink = io.StringIO()
+        downplay.render(SCRIPTS[script],fmt,sink)
+    return sink.getvalue()
+
+
+def test_concurrent_renders_match_serial():
+    rng = random.Random(0)
+    jobs = [ (rng.randrange(len(SCRIPTS)),rng.choice(FORMATS))
+             for i in range(N_RENDERS) ]
+    serial = { job: render_job(job) for job in set(jobs) }
+    with concurrent.futures.ThreadPoolExecutor(N_THREADS) as executor:
+        results = list(executor.map(render_job,jobs))
+    for job,result in zip(jobs,results):
+        assert result == serial[job], "render %r differs from serial" % (job,)
+
+
+if __name__ == '__main__':
+    test_concurrent_renders_match_serial()
+    print("%d concurrent renders matched serial output" % N_RENDERS)